@@ -9,21 +9,44 @@ from std_srvs.srv import Empty, EmptyResponse
 
 import time, sys
 import math
-from threading import Thread
+from operator import itemgetter
+from threading import Thread, Event, Lock
 
-class CrazyflieROS:
+# conversion factors for the raw log values
+_DEG2RAD = math.pi / 180.0
+_G2MSS = 9.81
+
+# fetch all values of a log block from the data dictionary in a single call
+_imu_values = itemgetter("gyro.x", "gyro.y", "gyro.z", "acc.x", "acc.y", "acc.z")
+_log2_values = itemgetter("mag.x", "mag.y", "mag.z", "baro.temp", "baro.pressure", "pm.vbat")
+
+class CrazyflieROS(object):
     Disconnected = 0
     Connecting = 1
     Connected = 2
 
+    # one instance is created per Crazyflie; avoid a per-instance __dict__
+    __slots__ = ("link_uri", "tf_prefix", "roll_trim", "pitch_trim", "enable_logging",
+        "_base_frame", "_param_prefix", "_cf", "_send_cmd", "_time_now",
+        "_cmdVel", "_tx_lock", "_lastSetpointTime", "_subCmdVel",
+        "_pubImu", "_pubTemp", "_pubMag", "_pubPressure", "_pubBattery",
+        "_publish_imu", "_publish_temp", "_publish_mag", "_publish_pressure", "_publish_battery",
+        "_imu_msg", "_temp_msg", "_mag_msg", "_pressure_msg", "_battery_msg",
+        "_state", "_state_event", "_isEmergency",
+        "_lg_imu", "_lg_log2")
+
     """Wrapper between ROS and Crazyflie SDK"""
     def __init__(self, link_uri, tf_prefix, roll_trim, pitch_trim, enable_logging):
         self.link_uri = link_uri
         self.tf_prefix = tf_prefix
+        self._base_frame = tf_prefix + "/base_link"
+        self._param_prefix = "/" + tf_prefix + "/"
         self.roll_trim = roll_trim
         self.pitch_trim = pitch_trim
         self.enable_logging = enable_logging
         self._cf = Crazyflie()
+        self._send_cmd = self._cf.commander.send_setpoint
+        self._time_now = rospy.Time.now
 
         self._cf.connected.add_callback(self._connected)
         self._cf.disconnected.add_callback(self._disconnected)
@@ -32,15 +55,46 @@ class CrazyflieROS:
         self._cf.link_quality_updated.add_callback(self._link_quality_updated)
 
         self._cmdVel = Twist()
-        self._subCmdVel = rospy.Subscriber(tf_prefix + "/cmd_vel", Twist, self._cmdVelChanged)
-
-        self._pubImu = rospy.Publisher(tf_prefix + "/imu", Imu, queue_size=10)
-        self._pubTemp = rospy.Publisher(tf_prefix + "/temperature", Temperature, queue_size=10)
-        self._pubMag = rospy.Publisher(tf_prefix + "/magnetic_field", MagneticField, queue_size=10)
-        self._pubPressure = rospy.Publisher(tf_prefix + "/pressure", Float32, queue_size=10)
-        self._pubBattery = rospy.Publisher(tf_prefix + "/battery", Float32, queue_size=10)
+        # setpoints are sent from the cmd_vel callback and the update thread
+        self._tx_lock = Lock()
+        self._lastSetpointTime = 0.0
+        # only the latest command is of interest; disable Nagle's algorithm
+        # since the Twist messages are tiny
+        self._subCmdVel = rospy.Subscriber(tf_prefix + "/cmd_vel", Twist, self._cmdVelChanged,
+            queue_size=1, tcp_nodelay=True)
+
+        # the publishers are only needed (and registered with the master)
+        # if logging is enabled
+        if self.enable_logging:
+            self._pubImu = rospy.Publisher(tf_prefix + "/imu", Imu, queue_size=10)
+            self._pubTemp = rospy.Publisher(tf_prefix + "/temperature", Temperature, queue_size=10)
+            self._pubMag = rospy.Publisher(tf_prefix + "/magnetic_field", MagneticField, queue_size=10)
+            self._pubPressure = rospy.Publisher(tf_prefix + "/pressure", Float32, queue_size=10)
+            self._pubBattery = rospy.Publisher(tf_prefix + "/battery", Float32, queue_size=10)
+            self._publish_imu = self._pubImu.publish
+            self._publish_temp = self._pubTemp.publish
+            self._publish_mag = self._pubMag.publish
+            self._publish_pressure = self._pubPressure.publish
+            self._publish_battery = self._pubBattery.publish
+
+            # messages are re-used by the log callbacks; this is safe since
+            # publish() serializes synchronously and the log callbacks are all
+            # called from the same link thread
+            self._imu_msg = Imu()
+            self._imu_msg.header.frame_id = self._base_frame
+            self._imu_msg.orientation_covariance[0] = -1 # orientation not supported
+            self._temp_msg = Temperature()
+            self._temp_msg.header.frame_id = self._base_frame
+            self._mag_msg = MagneticField()
+            self._mag_msg.header.frame_id = self._base_frame
+            self._pressure_msg = Float32()
+            self._battery_msg = Float32()
 
         self._state = CrazyflieROS.Disconnected
+        # signals the update thread that the connection state changed
+        self._state_event = Event()
+        # make sure that the update thread notices a ROS shutdown
+        rospy.on_shutdown(self._state_event.set)
 
         rospy.Service(tf_prefix + "/update_params", UpdateParams, self._update_params)
         rospy.Service(tf_prefix + "/emergency", Empty, self._emergency)
@@ -51,6 +105,7 @@ class CrazyflieROS:
     def _try_to_connect(self):
         rospy.loginfo("Connecting to %s" % self.link_uri)
         self._state = CrazyflieROS.Connecting
+        self._state_event.clear()
         self._cf.open_link(self.link_uri)
 
     def _connected(self, link_uri):
@@ -59,6 +114,7 @@ class CrazyflieROS:
 
         rospy.loginfo("Connected to %s" % link_uri)
         self._state = CrazyflieROS.Connected
+        self._state_event.set()
 
         if self.enable_logging:
             self._lg_imu = LogConfig(name="IMU", period_in_ms=10)
@@ -122,34 +178,48 @@ class CrazyflieROS:
         #    rospy.logfatal("Could not add logconfig since some variables are not in TOC")
 
 
+        # synchronizing the parameters takes a while; don't block the link
+        # thread of cflib while doing so
+        Thread(target=self._sync_params, name="sync_params " + self.link_uri).start()
+
+    def _sync_params(self):
+        """Pushes ROS parameters to the Crazyflie and requests the values of
+        all other parameters in its TOC"""
+        # fetch the whole namespace at once rather than querying the
+        # parameter server for each single parameter
+        ros_params = rospy.get_param("/" + self.tf_prefix, {})
+        set_value = self._cf.param.set_value
+        request_param_update = self._cf.param.request_param_update
         p_toc = self._cf.param.toc.toc
-        for group in p_toc.keys():
+        for group, entries in p_toc.items():
             self._cf.param.add_update_callback(group=group, name=None, cb=self._param_callback)
-            for name in p_toc[group].keys():
-                ros_param = "/{}/{}/{}".format(self.tf_prefix, group, name)
-                cf_param = "{}.{}".format(group, name)
-                if rospy.has_param(ros_param):
-                    self._cf.param.set_value(cf_param, rospy.get_param(ros_param))
+            group_params = ros_params.get(group, {})
+            for name in entries:
+                cf_param = "%s.%s" % (group, name)
+                if name in group_params:
+                    set_value(cf_param, group_params[name])
                 else:
-                    self._cf.param.request_param_update(cf_param)
-
+                    request_param_update(cf_param)
 
     def _connection_failed(self, link_uri, msg):
         """Callback when connection initial connection fails (i.e no Crazyflie
         at the speficied address)"""
         rospy.logfatal("Connection to %s failed: %s" % (link_uri, msg))
         self._state = CrazyflieROS.Disconnected
+        self._state_event.set()
 
     def _connection_lost(self, link_uri, msg):
         """Callback when disconnected after a connection has been made (i.e
         Crazyflie moves out of range)"""
         rospy.logfatal("Connection to %s lost: %s" % (link_uri, msg))
         self._state = CrazyflieROS.Disconnected
+        self._state_event.set()
 
     def _disconnected(self, link_uri):
         """Callback when the Crazyflie is disconnected (called in all cases)"""
         rospy.logfatal("Disconnected from %s" % link_uri)
         self._state = CrazyflieROS.Disconnected
+        self._state_event.set()
 
     def _link_quality_updated(self, percentage):
         """Called when the link driver updates the link quality measurement"""
@@ -163,83 +233,97 @@ class CrazyflieROS:
 
     def _log_data_imu(self, timestamp, data, logconf):
         """Callback froma the log API when data arrives"""
-        msg = Imu()
+        gx, gy, gz, ax, ay, az = _imu_values(data)
+
+        msg = self._imu_msg
         # ToDo: it would be better to convert from timestamp to rospy time
-        msg.header.stamp = rospy.Time.now()
-        msg.header.frame_id = self.tf_prefix + "/base_link"
-        msg.orientation_covariance[0] = -1 # orientation not supported
+        msg.header.stamp = self._time_now()
 
         # measured in deg/s; need to convert to rad/s
-        msg.angular_velocity.x = math.radians(data["gyro.x"])
-        msg.angular_velocity.y = math.radians(data["gyro.y"])
-        msg.angular_velocity.z = math.radians(data["gyro.z"])
+        msg.angular_velocity.x = gx * _DEG2RAD
+        msg.angular_velocity.y = gy * _DEG2RAD
+        msg.angular_velocity.z = gz * _DEG2RAD
 
-        # measured in mG; need to convert to m/s^2
-        msg.linear_acceleration.x = data["acc.x"] * 9.81
-        msg.linear_acceleration.y = data["acc.y"] * 9.81
-        msg.linear_acceleration.z = data["acc.z"] * 9.81
+        # measured in g; need to convert to m/s^2
+        msg.linear_acceleration.x = ax * _G2MSS
+        msg.linear_acceleration.y = ay * _G2MSS
+        msg.linear_acceleration.z = az * _G2MSS
 
-        self._pubImu.publish(msg)
+        self._publish_imu(msg)
 
         #print "[%d][%s]: %s" % (timestamp, logconf.name, data)
 
     def _log_data_log2(self, timestamp, data, logconf):
         """Callback froma the log API when data arrives"""
-        msg = Temperature()
         # ToDo: it would be better to convert from timestamp to rospy time
-        msg.header.stamp = rospy.Time.now()
-        msg.header.frame_id = self.tf_prefix + "/base_link"
+        # use a single timestamp so that all messages are coherent
+        now = self._time_now()
+        mx, my, mz, temp, pressure, vbat = _log2_values(data)
+
+        msg = self._temp_msg
+        msg.header.stamp = now
         # measured in degC
-        msg.temperature = data["baro.temp"]
-        self._pubTemp.publish(msg)
+        msg.temperature = temp
+        self._publish_temp(msg)
 
-        # ToDo: it would be better to convert from timestamp to rospy time
-        msg = MagneticField()
-        msg.header.stamp = rospy.Time.now()
-        msg.header.frame_id = self.tf_prefix + "/base_link"
+        msg = self._mag_msg
+        msg.header.stamp = now
 
         # measured in Tesla
-        msg.magnetic_field.x = data["mag.x"]
-        msg.magnetic_field.y = data["mag.y"]
-        msg.magnetic_field.z = data["mag.z"]
+        msg.magnetic_field.x = mx
+        msg.magnetic_field.y = my
+        msg.magnetic_field.z = mz
 
-        self._pubMag.publish(msg)
+        self._publish_mag(msg)
 
-        msg = Float32()
+        msg = self._pressure_msg
         # hPa (=mbar)
-        msg.data = data["baro.pressure"]
-        self._pubPressure.publish(msg)
+        msg.data = pressure
+        self._publish_pressure(msg)
 
+        msg = self._battery_msg
         # V
-        msg.data = data["pm.vbat"]
-        self._pubBattery.publish(msg)
+        msg.data = vbat
+        self._publish_battery(msg)
 
     def _param_callback(self, name, value):
-        ros_param = "{}/{}".format(self.tf_prefix, name.replace(".", "/"))
-        rospy.set_param(ros_param, value)
+        rospy.set_param(self._param_prefix + name.replace(".", "/"), value)
 
     def _update_params(self, req):
         rospy.loginfo("Update parameters %s" % (str(req.params)))
+        get_param = rospy.get_param
+        set_value = self._cf.param.set_value
+        prefix = self._param_prefix
         for param in req.params:
-            ros_param = "/{}/{}".format(self.tf_prefix, param)
             cf_param = param.replace("/", ".")
-            print(cf_param)
-            #if rospy.has_param(ros_param):
-            self._cf.param.set_value(cf_param, str(rospy.get_param(ros_param)))
+            rospy.logdebug("Setting %s", cf_param)
+            #if rospy.has_param(prefix + param):
+            set_value(cf_param, str(get_param(prefix + param)))
         return UpdateParamsResponse()
 
     def _emergency(self, req):
         rospy.logfatal("Emergency requested!")
-        self._isEmergency = True
+        # stop the motors right away rather than waiting for the update thread
+        with self._tx_lock:
+            self._isEmergency = True
+            self._send_cmd(0, 0, 0, 0)
+        # only wakes the update thread while it waits for a connection
+        self._state_event.set()
         return EmptyResponse()
 
     def _send_setpoint(self):
         roll = self._cmdVel.linear.y + self.roll_trim
         pitch = self._cmdVel.linear.x + self.pitch_trim
         yawrate = self._cmdVel.angular.z
-        thrust = min(max(0, int(self._cmdVel.linear.z)), 60000)
+        z = self._cmdVel.linear.z
+        thrust = 0 if z < 0 else (60000 if z > 60000 else int(z))
         #print(roll, pitch, yawrate, thrust)
-        self._cf.commander.send_setpoint(roll, pitch, yawrate, thrust)
+        with self._tx_lock:
+            # don't override the zero setpoint sent by _emergency
+            if self._isEmergency:
+                return
+            self._send_cmd(roll, pitch, yawrate, thrust)
+            self._lastSetpointTime = time.time()
 
     def _cmdVelChanged(self, data):
         self._cmdVel = data
@@ -254,28 +338,44 @@ class CrazyflieROS:
             if self._state == CrazyflieROS.Disconnected:
                 self._try_to_connect()
             elif self._state == CrazyflieROS.Connected:
+                # Setpoints are sent as soon as a new cmd_vel arrives.
                 # Crazyflie will shut down if we don't send any command for 500ms
-                # Hence, make sure that we don't wait too long
+                # Hence, repeat the last setpoint if nothing was sent for 400ms
                 # However, if there is no connection anymore, we try to get the flie down
-                if self._subCmdVel.get_num_connections() > 0:
-                    self._send_setpoint()
-                else:
+                if self._subCmdVel.get_num_connections() == 0:
                     self._cmdVel = Twist()
                     self._send_setpoint()
-                rospy.sleep(0.2)
+                else:
+                    # a negative value means the clock was set back; send now
+                    dt = time.time() - self._lastSetpointTime
+                    if dt >= 0.4 or dt < 0:
+                        self._send_setpoint()
+                # bound the sleep, the wall clock might jump
+                time.sleep(min(0.4, max(0.0, self._lastSetpointTime + 0.4 - time.time())))
             else:
-                rospy.sleep(0.5)
+                # wait for the connection attempt to succeed or fail
+                # (no timeout: a timed wait polls on Python 2)
+                self._state_event.wait()
+        # rospy.sleep can't be used here since ROS may be shutting down
         for i in range(0, 100):
-            self._cf.commander.send_setpoint(0, 0, 0, 0)
-            rospy.sleep(0.01)
+            self._send_cmd(0, 0, 0, 0)
+            time.sleep(0.01)
         # Make sure that the last packet leaves before the link is closed
         # since the message queue is not flushed before closing
-        rospy.sleep(0.1)
+        time.sleep(0.1)
         self._cf.close_link()
 
+# all Crazyflies handled by this server, by tf_prefix
+_crazyflies = {}
+# rospy handles each service request in its own thread
+_crazyfliesLock = Lock()
+
 def add_crazyflie(req):
-    rospy.loginfo("Adding %s as %s with trim(%f, %f). Logging: %s" % (req.uri, req.tf_prefix, req.roll_trim, req.pitch_trim, str(req.enable_logging)))
-    CrazyflieROS(req.uri, req.tf_prefix, req.roll_trim, req.pitch_trim, req.enable_logging)
+    with _crazyfliesLock:
+        if req.tf_prefix in _crazyflies:
+            raise rospy.ServiceException("Crazyflie with tf_prefix '%s' already exists" % req.tf_prefix)
+        rospy.loginfo("Adding %s as %s with trim(%f, %f). Logging: %s" % (req.uri, req.tf_prefix, req.roll_trim, req.pitch_trim, str(req.enable_logging)))
+        _crazyflies[req.tf_prefix] = CrazyflieROS(req.uri, req.tf_prefix, req.roll_trim, req.pitch_trim, req.enable_logging)
     return AddCrazyflieResponse()
 
 if __name__ == '__main__':